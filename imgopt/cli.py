@@ -1,13 +1,20 @@
 #!/usr/bin/env python3
 import argparse
+import io
+import multiprocessing
+import os
 import sys
 import time
 import signal
 import logging
+import mmap
 from pathlib import Path
-from concurrent.futures import ProcessPoolExecutor
-from PIL import Image
-from typing import Optional, Tuple, List, Union, Any, NamedTuple
+from contextlib import contextmanager
+from concurrent.futures import Future, ThreadPoolExecutor, FIRST_COMPLETED, wait
+from PIL import Image, UnidentifiedImageError, features, __version__ as pillow_version
+from tqdm import tqdm
+from tqdm.contrib.logging import logging_redirect_tqdm
+from typing import Optional, Tuple, List, Union, Any, NamedTuple, Iterator
 
 # --- Project Metadata ---
 __version__ = "1.0.0"
@@ -15,6 +22,26 @@ __prog_name__ = "imgopt"
 
 # --- Configuration ---
 EXTENSIONS = {'.png', '.jpg', '.jpeg', '.bmp', '.tiff'}
+SKIP_RECOMPRESS = {'.webp'}  # With --copy-webp: copied unchanged unless they need resizing
+MMAP_MIN_SIZE = 16 * 1024 * 1024  # Larger sources are memory-mapped instead of copied
+PALETTE_MAX_COLORS = 256  # PNGs with this few colors are encoded losslessly
+BATCH_SIZE = 8  # Max images handed to a worker process per IPC round-trip
+THREADS_PER_WORKER = 2  # Overlaps one image's file I/O with another's encode
+READER_THREADS = 4  # Threads prefetching source files ahead of the encoders
+PREFETCH_PER_THREAD = 2  # Images in flight per encoder thread (bounds memory)
+LOG_BATCH_SIZE = 64  # Per-file "OK" lines written to stdout in one go
+
+# Tuple, not set: str.endswith tests every suffix in one C-level call
+SCAN_EXTENSIONS = tuple(EXTENSIONS)
+SCAN_EXTENSIONS_WEBP = tuple(EXTENSIONS | SKIP_RECOMPRESS)
+
+# Largest image (in pixels) a worker will decode, a little under Pillow's default (~179 MP).
+# Checked after draft() instead of in Image.open, so huge JPEGs can still be decoded scaled down.
+MAX_PIXELS = 160_000_000
+Image.MAX_IMAGE_PIXELS = None
+
+# Expected per-file failures: I/O problems, plus how Pillow reports corrupt data and unsupported modes
+RECOVERABLE_ERRORS = (OSError, ValueError, SyntaxError, Image.DecompressionBombError)
 
 # --- Logging Setup ---
 logging.basicConfig(
@@ -25,11 +52,14 @@ logging.basicConfig(
 logger = logging.getLogger()
 
 class ImageTask(NamedTuple):
-    file_path: Path
-    output_root: Path
-    input_root: Path
+    source: str  # Input image path
+    target: str  # Output .webp path, precomputed in main()
+
+class JobConfig(NamedTuple):
     quality: int
     max_width: Optional[int]
+    method: int
+    lossless: bool
 
 def signal_handler(sig, frame) -> None:
     """Handle termination signals (Ctrl+C) gracefully."""
@@ -111,32 +141,284 @@ def get_unique_output_folder(base_folder: Path, name: str) -> Path:
             counter += 1
     return output_path
 
-def process_single_image(task: ImageTask) -> Tuple[bool, str, int, int]:
+def scan_images(folder: Union[Path, str], exclude: Path,
+                suffixes: Tuple[str, ...] = SCAN_EXTENSIONS) -> Iterator[Tuple[str, os.stat_result]]:
+    """
+    Recursively yields images under folder ending in one of suffixes, with their
+    stat results, skipping the exclude tree. Uses os.scandir so directories and
+    rejected names are classified without any stat calls; only matching files
+    are stat'ed.
+    """
+    exclude_str = str(exclude)
+    try:
+        entries = list(os.scandir(folder))
+    except OSError:
+        return
+
+    for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+            if entry.path != exclude_str:
+                yield from scan_images(entry.path, exclude, suffixes)
+        elif entry.name.lower().endswith(suffixes) and entry.is_file():
+            try:
+                yield entry.path, entry.stat()
+            except OSError:
+                continue
+
+def make_task(source: str, input_root: str, output_root: str) -> ImageTask:
+    """Maps a source path under input_root to its .webp path under output_root."""
+    relative = source[len(input_root):].lstrip(os.sep + (os.altsep or ''))
+    return ImageTask(source, os.path.splitext(os.path.join(output_root, relative))[0] + '.webp')
+
+def kept_original_path(task: ImageTask) -> str:
+    """Output path used when the original file is kept instead of its WebP."""
+    return os.path.splitext(task.target)[0] + os.path.splitext(task.source)[1]
+
+def is_up_to_date(task: ImageTask, source_mtime_ns: int) -> bool:
+    """Checks whether an output for the task (WebP or kept original) is newer than the source."""
+    for output_path in (task.target, kept_original_path(task)):
+        try:
+            if os.stat(output_path).st_mtime_ns >= source_mtime_ns:
+                return True
+        except OSError:
+            continue
+    return False
+
+def read_source(file_path: str) -> Union[bytes, mmap.mmap]:
+    """
+    Loads a source file for decoding in as few syscalls as possible.
+    Large files are memory-mapped so the decoder reads straight from the
+    page cache instead of from a private copy of the whole file.
+    """
+    with open(file_path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size < MMAP_MIN_SIZE:
+            return f.read()
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    # Start readahead now; on a reader thread this overlaps with other encodes
+    if hasattr(mmap, 'MADV_WILLNEED'):
+        mapped.madvise(mmap.MADV_WILLNEED)
+    return mapped
+
+def write_atomic(path: str, data: Any) -> int:
+    """
+    Writes data next to path and renames it into place, so an interrupted run
+    never leaves a truncated image that a later run would treat as up to date.
+    """
+    tmp_path = path + '.tmp'
+    try:
+        with open(tmp_path, 'wb') as f:
+            written = f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return written
+
+# Settings shared by every image in the job, set once per process by _init_worker
+_config: Optional[JobConfig] = None
+
+def process_single_image(task: ImageTask, source_data: Optional[Future] = None) -> Tuple[bool, str, int, int]:
     """
     Core image processing logic.
     Handles resizing and conversion to WebP.
+    source_data optionally holds the file's contents being read ahead by another thread.
     """
+    cfg = _config
+    # Bound once; None means "convert only" and short-circuits every resize step below
+    max_width = cfg.max_width
+    name = os.path.basename(task.source)
+    data = None
     try:
-        relative_path = task.file_path.relative_to(task.input_root)
-        output_file_path = task.output_root / relative_path.with_suffix('.webp')
-        output_file_path.parent.mkdir(parents=True, exist_ok=True)
+        # Read the whole source up front instead of the decoder's block-sized reads
+        data = source_data.result() if source_data is not None else read_source(task.source)
+        original_size = len(data)
+        # Pillow can read a mapping directly; plain bytes need a file-like wrapper
+        source = data if isinstance(data, mmap.mmap) else io.BytesIO(data)
+
+        with Image.open(source) as img:
+            needs_resize = max_width is not None and img.width > max_width
+
+            # Transcoding a WebP that already fits only costs quality, so copy it
+            if os.path.splitext(task.source)[1].lower() in SKIP_RECOMPRESS and not needs_resize:
+                new_size = write_atomic(task.target, data)
+                return (True, f"{name} (copied)", original_size, new_size)
+
+            # Logos and screenshots come out smaller (and encode faster) as lossless WebP,
+            # unless resampling is about to blend their few colors into thousands
+            lossless = cfg.lossless or (not needs_resize and img.format == 'PNG' and (
+                img.mode == 'P' or (img.mode in ('L', 'LA', 'RGB', 'RGBA')
+                                    and img.getcolors(PALETTE_MAX_COLORS) is not None)))
+
+            # Let libjpeg decode at a reduced scale (1/2, 1/4, 1/8) when downscaling
+            if needs_resize and img.format == 'JPEG':
+                img.draft('RGB', (max_width, int(img.height * max_width / img.width)))
+
+            if img.width * img.height > MAX_PIXELS:
+                raise Image.DecompressionBombError(
+                    f"image is {img.width * img.height} pixels, over the {MAX_PIXELS} pixel limit")
+
+            # Drop channels the encoder would otherwise carry for nothing
+            if img.mode == 'P':
+                img = img.convert('RGBA' if 'transparency' in img.info else 'RGB')
+            if img.mode == 'RGBA' and img.getchannel('A').getextrema()[0] == 255:
+                img = img.convert('RGB')
 
-        original_size = task.file_path.stat().st_size
-        
-        with Image.open(task.file_path) as img:
             # Smart Resize
-            if task.max_width and img.width > task.max_width:
-                ratio = task.max_width / img.width
+            if needs_resize and img.width > max_width:
+                # Box-average very large sources first so LANCZOS runs on far fewer pixels
+                factor = img.width // (max_width * 2)
+                if factor >= 2 and img.mode in ('L', 'LA', 'RGB', 'RGBA', 'I', 'F'):
+                    img = img.reduce(factor)
+
+                ratio = max_width / img.width
                 new_height = int(img.height * ratio)
-                img = img.resize((task.max_width, new_height), Image.Resampling.LANCZOS)
+                img = img.resize((max_width, new_height), Image.Resampling.LANCZOS)
+
+            buffer = io.BytesIO()
+            img.save(buffer, 'webp', lossless=lossless, quality=cfg.quality, method=cfg.method)
+            # Release decoded pixels (including any resized copy) before touching the disk
+            img.close()
+
+        # Keep the original if re-encoding at the same size would only make it bigger
+        if not needs_resize and buffer.getbuffer().nbytes >= original_size:
+            new_size = write_atomic(kept_original_path(task), data)
+            return (True, f"{name} (original kept)", original_size, new_size)
+
+        # Single write keeps disk I/O out of the encoder's output loop
+        new_size = write_atomic(task.target, buffer.getbuffer())
+        return (True, name, original_size, new_size)
+
+    except UnidentifiedImageError:
+        return (False, f"{name}: cannot identify image file", 0, 0)
+    except RECOVERABLE_ERRORS as e:
+        return (False, f"{name}: {e}", 0, 0)
+    finally:
+        if isinstance(data, mmap.mmap):
+            data.close()
+
+def process_image(task: ImageTask, source_data: Optional[Future] = None) -> Tuple[bool, str, int, int]:
+    """
+    Entry point used by every dispatcher. Anything process_single_image does not
+    expect is still reported as a failure for that file instead of stopping the run.
+    """
+    try:
+        return process_single_image(task, source_data)
+    except Exception as e:
+        return (False, f"{os.path.basename(task.source)}: unexpected error: {e!r}", 0, 0)
 
-            img.save(output_file_path, 'webp', quality=task.quality, method=6)
-            
-        new_size = output_file_path.stat().st_size
-        return (True, task.file_path.name, original_size, new_size)
+def flush_lines(lines: List[str]) -> None:
+    """Writes buffered log lines to stdout in a single call and empties the buffer."""
+    if lines:
+        sys.stdout.write("\n".join(lines) + "\n")
+        lines.clear()
 
-    except Exception as e:
-        return (False, f"{task.file_path.name}: {e}", 0, 0)
+# Per-process thread pool, created by _init_worker in each pool worker
+_batch_executor: Optional[ThreadPoolExecutor] = None
+
+def _set_config(config: JobConfig) -> None:
+    """Stores the job settings, so tasks only need to carry their file paths."""
+    global _config
+    _config = config
+
+def _init_worker(config: JobConfig) -> None:
+    """
+    Worker process initializer: stores the job settings, loads Pillow's format
+    plugins and the WebP codec once, and starts the batch thread pool.
+    """
+    global _batch_executor
+    _set_config(config)
+    Image.init()
+    features.check('webp')
+    _batch_executor = ThreadPoolExecutor(max_workers=THREADS_PER_WORKER)
+
+def process_batch(tasks: List[ImageTask]) -> List[Tuple[bool, str, int, int]]:
+    """
+    Processes a batch of images inside one worker process.
+    Pillow releases the GIL while decoding and encoding, so a second thread
+    keeps the next image moving while the current one reads or writes.
+    """
+    return list(_batch_executor.map(process_image, tasks))
+
+def _get_mp_context() -> Any:
+    """Prefers fork (no re-import per worker) where it is safe; spawn elsewhere."""
+    if sys.platform.startswith('linux'):
+        return multiprocessing.get_context('fork')
+    return multiprocessing.get_context('spawn')
+
+def _run_pipeline(tasks: List[ImageTask], workers: int) -> Iterator[Tuple[bool, str, int, int]]:
+    """
+    Two-stage thread pipeline: reader threads load source files ahead of time
+    while encoder threads decode, resize and encode the ones already read.
+    Only a bounded window of images is in flight, which also caps memory use.
+    """
+    pending_tasks = iter(tasks)
+    in_flight = {}  # encode future -> read future
+
+    with ThreadPoolExecutor(max_workers=READER_THREADS) as readers, \
+         ThreadPoolExecutor(max_workers=workers) as encoders:
+
+        def submit_next() -> None:
+            task = next(pending_tasks, None)
+            if task is not None:
+                read = readers.submit(read_source, task.source)
+                in_flight[encoders.submit(process_image, task, read)] = read
+
+        for _ in range(workers * PREFETCH_PER_THREAD):
+            submit_next()
+
+        try:
+            while in_flight:
+                # Report in completion order so one slow image doesn't hold back the rest
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    del in_flight[future]
+                    submit_next()
+                    yield future.result()
+        finally:
+            # Closing this generator early cancels every image not yet started
+            for encode, read in in_flight.items():
+                encode.cancel()
+                read.cancel()
+
+@contextmanager
+def run_tasks(tasks: List[ImageTask], config: JobConfig,
+              use_processes: bool = False) -> Iterator[Iterator[Tuple[bool, str, int, int]]]:
+    """
+    Starts dispatching tasks to a thread pool (or a process pool) and yields an
+    iterator over results as they complete; leaving the block stops the pool.
+    Pillow releases the GIL while decoding, resizing and encoding, so threads run
+    in parallel without process startup or pickling costs.
+    A single image is processed inline to avoid the pool startup cost.
+    """
+    if len(tasks) == 1:
+        _set_config(config)
+        yield iter([process_image(tasks[0])])
+        return
+
+    workers = min(os.cpu_count() or 1, len(tasks))
+
+    if not use_processes:
+        _set_config(config)
+        results = _run_pipeline(tasks, workers)
+        try:
+            yield results
+        finally:
+            # Cancel queued work now rather than when the generator is garbage collected
+            results.close()
+        return
+
+    # Small jobs get smaller batches so every worker still has something to do
+    batch_size = max(1, min(BATCH_SIZE, len(tasks) // workers))
+    # Stride rather than slice, so the largest files are spread across batches
+    batch_count = -(-len(tasks) // batch_size)
+    batches = [tasks[i::batch_count] for i in range(batch_count)]
+    with _get_mp_context().Pool(processes=workers, initializer=_init_worker, initargs=(config,)) as pool:
+        yield (result for batch in pool.imap_unordered(process_batch, batches) for result in batch)
+        # Let workers exit cleanly; leaving the block early terminates them instead
+        pool.close()
+        pool.join()
 
 def main():
     """
@@ -152,6 +434,7 @@ def main():
                "  imgopt                         (Interactive Wizard)\n"
                "  imgopt ./photos -q 90          (Quick mode, high quality)\n"
                "  imgopt ./photos -w 0           (Convert only, no resize)\n"
+               "  imgopt ./photos -m 6           (Smallest files, slowest encode)\n"
                "  imgopt ./photos --output dist  (Custom output folder)"
     )
     
@@ -169,12 +452,30 @@ def main():
     parser.add_argument("-q", "--quality", type=int, default=80,
                         help="WebP quality (0-100) (default: 80).")
     
+    parser.add_argument("-m", "--method", type=int, default=4, choices=range(7), metavar="0-6",
+                        help="WebP encoder effort (0=fastest, 6=slowest) (default: 4).\n"
+                             "6 is libwebp's max-effort search: much slower for a slightly smaller file.")
+    
+    parser.add_argument("--lossless", action="store_true",
+                        help="Encode every image as lossless WebP (best for screenshots and logos).\n"
+                             "By default only PNGs with 256 colors or fewer are lossless.")
+    
     parser.add_argument("-i", "--interactive", action="store_true", 
                         help="Force launch of the interactive wizard.")
     
     parser.add_argument("--quiet", action="store_true", 
                         help="Suppress per-file logs, showing only the final summary.")
     
+    parser.add_argument("--copy-webp", action="store_true",
+                        help="Also pick up existing .webp files (copied as-is unless they need resizing).")
+    
+    parser.add_argument("-f", "--force", action="store_true",
+                        help="Convert every image, even if its output is newer than the source.")
+    
+    parser.add_argument("--processes", action="store_true",
+                        help="Use worker processes instead of threads.\n"
+                             "Only needed with Pillow builds that do not release the GIL.")
+    
     parser.add_argument("--no-sound", action="store_true", 
                         help="Disable the completion notification sound (Beep).")
 
@@ -185,8 +486,13 @@ def main():
     target_width = None
     output_folder_name = args.output
     quality = args.quality
+    method = args.method
+    lossless = args.lossless
     verbose = not args.quiet
     play_sound = not args.no_sound
+    use_processes = args.processes
+    force = args.force
+    copy_webp = args.copy_webp
     is_interactive = args.interactive
 
     # Auto-trigger interactive if no path is given
@@ -247,67 +553,104 @@ def main():
     output_dir.mkdir(exist_ok=True)
 
     logger.info("Scanning...")
-    files = [
-        f for f in input_dir.rglob("*") 
-        if f.suffix.lower() in EXTENSIONS 
-        and f.is_file() 
-        and output_dir not in f.parents
+    # Output paths are built once here, with plain string operations
+    input_root, output_root = str(input_dir), str(output_dir)
+    scanned = [
+        (make_task(path, input_root, output_root), st)
+        for path, st in scan_images(input_dir, output_dir,
+                                    SCAN_EXTENSIONS_WEBP if copy_webp else SCAN_EXTENSIONS)
     ]
 
-    if not files:
+    if not scanned:
         logger.warning("No images found.")
         sys.exit(0)
 
+    # Incremental runs: leave alone anything already converted since it last changed
+    pending = scanned
+    if not force:
+        pending = [(t, st) for t, st in scanned if not is_up_to_date(t, st.st_mtime_ns)]
+    skipped = len(scanned) - len(pending)
+
+    # Largest first, so big images don't end up alone at the tail of the run
+    pending.sort(key=lambda item: item[1].st_size, reverse=True)
+    tasks = [t for t, _ in pending]
+
+    if not tasks:
+        logger.info(f"All {skipped} images are up to date (use --force to convert again).")
+        sys.exit(0)
+
     # Info Summary
     logger.info("-" * 40)
     logger.info(f"Source:  {input_dir}")
     logger.info(f"Target:  {output_dir.name}")
-    logger.info(f"Files:   {len(files)}")
+    logger.info(f"Files:   {len(tasks)}" + (f" ({skipped} up to date, skipped)" if skipped else ""))
     logger.info(f"Width:   {target_width if target_width else 'Original'}")
     logger.info(f"Quality: {quality}")
+    logger.info(f"Method:  {method}")
+    logger.info(f"Mode:    {'Lossless' if lossless else 'Lossy (lossless for flat PNGs)'}")
+    logger.info(f"Encoder: libwebp {features.version('webp') or 'unknown'} (Pillow {pillow_version})")
     logger.info("-" * 40)
+
+    # Official wheels bundle libjpeg-turbo; some distro/source builds do not
+    if not features.check_feature('libjpeg_turbo') and any(
+            t.source.lower().endswith(('.jpg', '.jpeg')) for t in tasks):
+        logger.warning("Warning: Pillow is not using libjpeg-turbo; JPEG decoding will be slower.")
     
     start_time = time.time()
+
+    # Mirror the source tree up front instead of one mkdir per image
+    for folder in {os.path.dirname(t.target) for t in tasks}:
+        os.makedirs(folder, exist_ok=True)
     
-    # Create Task Objects
-    tasks = [
-        ImageTask(f, output_dir, input_dir, quality, target_width) 
-        for f in files
-    ]
+    # Shared settings travel to each worker once; tasks carry only their two paths
+    config = JobConfig(quality, target_width, method, lossless)
     
     success = 0
     failed = 0
     orig_total = 0
     new_total = 0
+    ok_lines: List[str] = []
+
+    # Without per-file lines, show a self-throttling progress bar instead (terminals only)
+    show_progress = not verbose and sys.stderr.isatty()
 
     try:
-        with ProcessPoolExecutor() as executor:
-            results = executor.map(process_single_image, tasks)
-            for is_ok, msg, orig, new_s in results:
+        # Workers are started before tqdm is created, so no process forks next to its thread
+        with run_tasks(tasks, config, use_processes) as results, logging_redirect_tqdm(), \
+                tqdm(results, total=len(tasks), unit="img", disable=not show_progress) as progress:
+            for is_ok, msg, orig, new_s in progress:
                 if is_ok:
                     success += 1
                     orig_total += orig
                     new_total += new_s
-                    if verbose: logger.info(f"OK: {msg}")
+                    if verbose:
+                        ok_lines.append("OK: " + msg)
+                        if len(ok_lines) >= LOG_BATCH_SIZE: flush_lines(ok_lines)
                 else:
                     failed += 1
+                    flush_lines(ok_lines)
                     logger.error(f"FAIL: {msg}")
 
     except KeyboardInterrupt:
         logger.error("\nCancelled.")
         sys.exit(1)
+    finally:
+        flush_lines(ok_lines)
 
     saved = orig_total - new_total
     saved_mb = saved / (1024 * 1024)
     pct = (saved / orig_total * 100) if orig_total > 0 else 0
     
     logger.info("\n" + "=" * 40)
-    logger.info(f"Finished: {success} OK | {failed} Failed")
+    logger.info(f"Finished: {success} OK | {failed} Failed" + (f" | {skipped} Skipped" if skipped else ""))
+    if failed:
+        logger.info("Failed images are retried on every run until they convert.")
     logger.info(f"Saved:    {saved_mb:.2f} MB ({pct:.1f}%)")
     logger.info("=" * 40)
     
     if play_sound: print('\a') 
-    if success == 0 and len(files) > 0: sys.exit(1)
+    # Up-to-date images count as done, so a lone broken file doesn't fail every re-run
+    if success + skipped == 0: sys.exit(1)
     sys.exit(0)
 
 if __name__ == "__main__":